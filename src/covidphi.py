@@ -29,19 +29,27 @@ See sample.py for more examples.
 
 
 import csv
+import hashlib
+import json
+import re
+import unicodedata
 from datetime import datetime
 
 
-version = 'covidphi v0.18'
+version = 'covidphi v0.19'
 
 
 class DangerousCovid:    
     def __init__(self,
                  doh_file='../doc/Department of Health/DOH COVID Data Drop Case Information.csv',
                  address_file='../doc/Others/address reference.csv',
-                 psgc_file='../doc/Philippine Standard Geographic Code/PSGC Publication Dec2019.csv'):
+                 psgc_file='../doc/Philippine Standard Geographic Code/PSGC Publication Dec2019.csv',
+                 psgc_cache_file='../doc/Others/psgc code cache.json'):
+        self.__doh_file = doh_file
         self.__address_file = address_file
         self.__psgc_file = psgc_file
+        self.__psgc_cache_file = psgc_cache_file
+        self.__psgc_codes = None
         self.__data = DangerousCovid.__read_csv(doh_file, 'utf-8')
 
     @staticmethod
@@ -59,6 +67,170 @@ class DangerousCovid:
 
         return ret
 
+    @staticmethod
+    def __file_sha1(filename):
+        """
+        :param filename: the filename of file
+        :return: the sha1 hex digest of the file content
+        """
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                sha1.update(chunk)
+
+        return sha1.hexdigest()
+
+    @staticmethod
+    def __normalize_name(name, base=False):
+        """
+        Normalize a place name so that DOH and PSGC names can be compared.
+        Accents are removed, Parañaque becomes paranaque, and punctuation
+        and case are ignored. If base is true, text in parenthesis and the
+        "City of" prefix or "City" suffix are also removed.
+
+        :param name: place name
+        :param base: if true, reduce the name further to its base name
+        :return: normalized name
+        """
+        name = unicodedata.normalize('NFKD', name)
+        name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+        if base:
+            name = re.sub(r'\(.*?\)', ' ', name)
+        name = ' '.join(re.sub(r'[^a-z0-9]+', ' ', name).split())
+        if base:
+            name = re.sub(r'^city of | city$', '', name)
+
+        return name
+
+    @staticmethod
+    def __match_code(name, places, prefix=None, digits=0):
+        """
+        Find the code of name in places. The exact normalized name is tried
+        first then the base name. A match is only accepted if it is unique.
+
+        :param name: DOH place name
+        :param places: a list of (code, name, base name) from PSGC
+        :param prefix: if not None, only codes that start with it are considered
+        :param digits: the number of leading digits of code to compare with prefix
+        :return: the PSGC code or None if not found
+        """
+        candidates = [p for p in places if prefix is None or p[0] // 10 ** (9 - digits) == prefix]
+        for i, key in [(1, DangerousCovid.__normalize_name(name)),
+                       (2, DangerousCovid.__normalize_name(name, base=True))]:
+            found = {p[0] for p in candidates if p[i] == key}
+            if len(found) == 1:
+                return found.pop()
+
+        return None
+
+    def __build_psgc_codes(self):
+        """
+        Resolve every distinct DOH Region, Province and CityOrMuni to the
+        PSGC code of its most specific location. The (Region, Province, '')
+        parent of each entry is also resolved.
+
+        :return: a dict {(region, province, cityormuni): code or None}
+        """
+        regions, provinces, places = [], [], []
+        for p in DangerousCovid.__read_csv(self.__psgc_file):
+            code = p['Code']
+            if not code.isdigit() or len(code) != 9:
+                continue
+            level = p['Geographic Level']
+            entry = (int(code),
+                     DangerousCovid.__normalize_name(p['Name']),
+                     DangerousCovid.__normalize_name(p['Name'], base=True))
+            if level == 'Reg':
+                regions.append(entry)
+            # Rows without level are the "(Not a Province)" cities like
+            # City of Isabela and Cotabato City.
+            elif level in ['Prov', 'Dist', '']:
+                provinces.append(entry)
+            elif level in ['City', 'Mun']:
+                places.append(entry)
+
+        keys = set()
+        for doh in self.__data:
+            reg, prov, place = doh['Region'], doh['Province'], doh['CityOrMuni']
+            keys.add((reg, prov, place))
+            keys.add((reg, prov, ''))
+
+        ret = {}
+        for reg, prov, place in keys:
+            code = None
+            reg_code = prov_code = None
+            if reg != '':
+                reg_code = DangerousCovid.__match_code(reg, regions)
+                if reg_code is not None:
+                    code = reg_code
+                    reg_code //= 10 ** 7
+            if prov != '':
+                prov_code = DangerousCovid.__match_code(prov, provinces, reg_code, 2)
+                if prov_code is None:
+                    prov_code = DangerousCovid.__match_code(prov, provinces)
+                if prov_code is not None:
+                    code = prov_code
+                    prov_code //= 10 ** 5
+            if place != '':
+                # Search in province, then in region, then nationwide as DOH
+                # may use a different parent, i.e. Cotabato City in Maguindanao.
+                place_code = None
+                if prov_code is not None:
+                    place_code = DangerousCovid.__match_code(place, places, prov_code, 4)
+                if place_code is None and reg_code is not None:
+                    place_code = DangerousCovid.__match_code(place, places, reg_code, 2)
+                if place_code is None:
+                    place_code = DangerousCovid.__match_code(place, places)
+                if place_code is not None:
+                    code = place_code
+            ret.update({(reg, prov, place): code})
+
+        return ret
+
+    def psgc_codes(self):
+        """
+        Returns the PSGC code of every distinct DOH Region, Province and
+        CityOrMuni. The result is saved in the psgc cache file and is only
+        rebuilt when the DOH or PSGC file is changed.
+
+        :return: a dict {(region, province, cityormuni): code}, where code
+        is the 9-digit PSGC code as int or None if it is not resolved
+        """
+        if self.__psgc_codes is not None:
+            return self.__psgc_codes
+
+        doh_sha1 = DangerousCovid.__file_sha1(self.__doh_file)
+        psgc_sha1 = DangerousCovid.__file_sha1(self.__psgc_file)
+
+        try:
+            with open(self.__psgc_cache_file, encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache['doh_sha1'] == doh_sha1 and cache['psgc_sha1'] == psgc_sha1:
+                self.__psgc_codes = {
+                    (c['Region'], c['Province'], c['CityOrMuni']):
+                        None if c['Code'] is None else int(c['Code'])
+                    for c in cache['codes']}
+                return self.__psgc_codes
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        self.__psgc_codes = self.__build_psgc_codes()
+
+        cache = {
+            'doh_sha1': doh_sha1,
+            'psgc_sha1': psgc_sha1,
+            'codes': [{'Region': k[0], 'Province': k[1], 'CityOrMuni': k[2],
+                       'Code': None if v is None else f'{v:09d}'}
+                      for k, v in sorted(self.__psgc_codes.items())]
+        }
+        try:
+            with open(self.__psgc_cache_file, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False, indent=1)
+        except OSError:
+            print('Warning failed to write the psgc cache file!')
+
+        return self.__psgc_codes
+
     @staticmethod
     def save_to_file(output_file, data):
         """
@@ -131,17 +303,13 @@ class DangerousCovid:
                     continue
                 ret.append(prov)
         else:
+            # Province code is the first 4 digits of the 9-digit PSGC code.
+            doh_prov_codes = {c // 10 ** 5 for c in self.psgc_codes().values() if c is not None}
             psgc = DangerousCovid.__read_csv(self.__psgc_file)
             for p in psgc:
                 if p['Geographic Level'] == 'Prov':
-                    psgc_prov_name = p['Name']
-                    found = False
-                    for doh in self.__data:
-                        if doh['Province'].lower() == psgc_prov_name.lower():
-                            found = True
-                            break
-                    if not found:
-                        ret.append(psgc_prov_name.title())
+                    if int(p['Code']) // 10 ** 5 not in doh_prov_codes:
+                        ret.append(p['Name'].title())
 
         return sorted(list(set(ret)))
 
@@ -163,16 +331,12 @@ class DangerousCovid:
                     continue
                 ret.append(city)
         else:
+            doh_codes = set(self.psgc_codes().values())
             psgc = DangerousCovid.__read_csv(self.__psgc_file)
             for p in psgc:
                 if p['Geographic Level'] == 'City':
                     psgc_city_name = p['Name']
-                    found = False
-                    for doh in self.__data:
-                        if doh['City'].lower() == psgc_city_name.lower():
-                            found = True
-                            break
-                    if not found:
+                    if int(p['Code']) not in doh_codes:
                         psgc_city_name = psgc_city_name.title()
                         if 'City Of ' in psgc_city_name:
                             psgc_city_name = psgc_city_name.replace('City Of', 'City of')
@@ -198,16 +362,12 @@ class DangerousCovid:
                     continue
                 ret.append(muni)
         else:
+            doh_codes = set(self.psgc_codes().values())
             psgc = DangerousCovid.__read_csv(self.__psgc_file)
             for p in psgc:
                 if p['Geographic Level'] == 'Mun':
                     psgc_mun_name = p['Name']
-                    found = False
-                    for doh in self.__data:
-                        if doh['Municipality'].lower() == psgc_mun_name.lower():
-                            found = True
-                            break
-                    if not found:
+                    if int(p['Code']) not in doh_codes:
                         psgc_mun_name = psgc_mun_name.title()
                         ret.append(psgc_mun_name)
 